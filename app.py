@@ -1,19 +1,34 @@
 import os
 import logging
+import asyncio
 from dotenv import load_dotenv
-from slack_bolt import App
-from slack_bolt.adapter.socket_mode import SocketModeHandler
-from openai import OpenAI
-import requests
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.adapter.socket_mode.aiohttp import AsyncSocketModeHandler
+import openai
+from openai import AsyncOpenAI
+import httpx
+import orjson
+from tenacity import retry, retry_if_exception, retry_if_exception_type, stop_after_attempt, wait_random_exponential, before_sleep_log
 from io import BytesIO
-from PIL import Image
-import base64
-import pandas as pd # For reading local Excel/CSV file
+from PIL import Image, ImageOps
+try:
+    import pybase64 as base64  # Optional SIMD-accelerated drop-in for the stdlib module
+except ImportError:
+    import base64
+import csv # For reading the local example performance CSV
 import random # For selecting example images
 import time # Added for event deduplication
+import re
+import tempfile
+import threading
+import sqlite3
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
+module_logger = logging.getLogger(__name__)  # For helpers that run outside a Bolt listener
 
 # Load environment variables from .env file
 load_dotenv()
@@ -21,155 +36,1022 @@ load_dotenv()
 SLACK_BOT_TOKEN = os.environ.get("SLACK_BOT_TOKEN")
 SLACK_APP_TOKEN = os.environ.get("SLACK_APP_TOKEN") # Needed for Socket Mode
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+SLACK_USER_TOKEN = os.environ.get("SLACK_USER_TOKEN") # Only needed when SEND_PUBLIC_IMAGE_URLS is enabled
 
 # Initialize Slack Bolt app
+# The async app lets one process keep serving events while downloads and OpenAI calls are in flight.
 # For Socket Mode, SLACK_APP_TOKEN is required.
 # If you are not using Socket Mode (e.g., you have a public URL for event subscriptions),
-# you would initialize with: app = App(token=SLACK_BOT_TOKEN, signing_secret=SLACK_SIGNING_SECRET)
+# you would initialize with: app = AsyncApp(token=SLACK_BOT_TOKEN, signing_secret=SLACK_SIGNING_SECRET)
 # Make sure to also get SLACK_SIGNING_SECRET from your Slack app's "Basic Information" page if not using Socket Mode.
-app = App(token=SLACK_BOT_TOKEN)
+app = AsyncApp(token=SLACK_BOT_TOKEN)
+
+def _orjson_openapi_dumps(obj):
+    """Drop-in for the SDK's JSON body serializer; falls back to it for types orjson doesn't know (e.g. pydantic models).
+
+    Review prompts carry several base64 images, so bodies run to megabytes; orjson encodes
+    those strings several times faster than the stdlib json module.
+    """
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return _stdlib_openapi_dumps(obj)
+
+# openai._base_client.openapi_dumps is private; requirements.txt pins the openai releases this was verified against.
+# If a release drops the hook, requests still work, just serialized by the SDK's own encoder.
+_stdlib_openapi_dumps = getattr(openai._base_client, "openapi_dumps", None)
+if _stdlib_openapi_dumps is not None:
+    openai._base_client.openapi_dumps = _orjson_openapi_dumps
+else:
+    module_logger.warning("openai._base_client.openapi_dumps not found; OpenAI request bodies will not use orjson.")
 
 # Initialize OpenAI client
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# The SDK's own retries are disabled; _call_openai retries with jittered backoff instead.
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+# Shared HTTP client for Slack file downloads. Keep-alive connections to files.slack.com are pooled
+# across events (no TLS handshake per download), connect failures are retried at the transport level,
+# and the bot token is sent by default.
+slack_http_client = httpx.AsyncClient(
+    headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
+    # Fail fast on an unreachable host (the transport retries connects), but give slow reads the full 30s
+    timeout=httpx.Timeout(30, connect=3),
+    # Uploads arrive minutes apart, so idle connections are kept longer than httpx's 5-second default
+    transport=httpx.AsyncHTTPTransport(retries=3, limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60)),
+    follow_redirects=True,
+)
+
+# --- Concurrency Limits ---
+OPENAI_CONCURRENCY = int(os.environ.get("OPENAI_CONCURRENCY", "5"))  # Max vision calls in flight at once
+_openai_sem = asyncio.Semaphore(OPENAI_CONCURRENCY)
+OPENAI_RPM_LIMIT = int(os.environ.get("OPENAI_RPM_LIMIT", "500"))  # Requests per minute allowed by your OpenAI tier
+OPENAI_TPM_LIMIT = int(os.environ.get("OPENAI_TPM_LIMIT", "30000"))  # Tokens per minute allowed by your OpenAI tier
+OPENAI_MAX_TOKENS = 1000  # Completion budget per review; counts against TPM
+TOKENS_PER_IMAGE_ESTIMATE = 765  # GPT-4o cost of a typical high-detail image (4 tiles + base)
+TOKENS_PER_LOW_DETAIL_IMAGE = 85  # GPT-4o cost of an image sent with detail "low" (one fixed-size tile)
+# --- End Concurrency Limits ---
+
+class _TokenBucketLimiter:
+    """Client-side token bucket for OpenAI's requests-per-minute and tokens-per-minute quotas.
+
+    Requests wait here until both budgets have room, so bursts of reviews queue locally
+    instead of tripping 429s and falling back on retries.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.available_requests = float(requests_per_minute)
+        self.available_tokens = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.available_requests = min(self.request_capacity, self.available_requests + elapsed * self.request_capacity / 60)
+        self.available_tokens = min(self.token_capacity, self.available_tokens + elapsed * self.token_capacity / 60)
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.token_capacity)  # An oversized request still has to be able to go through eventually
+        # Waiters hold the lock while sleeping, so requests are admitted in arrival order
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                await asyncio.sleep(max(
+                    (1 - self.available_requests) * 60 / self.request_capacity,
+                    (tokens - self.available_tokens) * 60 / self.token_capacity,
+                ))
+
+# Shared by every handler so all reviews draw from the same budget
+_openai_rate_limiter = _TokenBucketLimiter(OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+
+# --- Retry Configuration ---
+OPENAI_MAX_ATTEMPTS = 3  # Attempts per OpenAI review call (rate limits, timeouts, 5xx)
+SLACK_DOWNLOAD_MAX_ATTEMPTS = 3  # Attempts per Slack file download (429, 5xx, network errors)
+SLACK_DOWNLOAD_MAX_WAIT_SECONDS = 30  # Cap on each wait between download attempts, including Slack's Retry-After
+# --- End Retry Configuration ---
 
 # --- Configuration for Example Images and Performance Data ---
 EXAMPLE_IMAGES_DIR = "./res/"  # <<< --- YOU NEED TO CREATE THIS DIRECTORY AND ADD IMAGES
 EXAMPLE_PERFORMANCE_CSV = "./res/Hack_Official_example.csv"  # <<< --- YOU NEED TO CREATE THIS CSV
 NUM_EXAMPLES_TO_INCLUDE = 5  # Number of example images to include in the prompt
+# The sampled examples are kept for this long so every review shares an identical prompt prefix,
+# which lets OpenAI's automatic prompt caching reuse it. Re-sampled afterwards to vary the context.
+EXAMPLE_SELECTION_REFRESH_SECONDS = 3600
 # Expected CSV columns: 'image_filename' (e.g., pic1.jpg), 'performance_info' (e.g., "High engagement, CTR 5%")
 # --- End Example Images Configuration ---
 
+# --- Configuration for Images Sent to OpenAI ---
+# Applies to uploads and (with EXAMPLE_MAX_SIDE) example images. GPT-4o never looks at more than 2048px on a side,
+# so anything larger is downscaled and re-encoded as JPEG to cut the request payload.
+DOWNSCALE_MAX_SIDE = 2048  # Images with a longer side (px) are downscaled to fit
+EXAMPLE_MAX_SIDE = 1024  # Tighter limit for example images, which are only reference context for the review
+MAX_UPLOAD_IMAGE_BYTES = 8 * 1024 * 1024  # Images larger than this are re-encoded as JPEG even if within DOWNSCALE_MAX_SIDE
+DOWNSCALE_JPEG_QUALITY = 85
+DOWNLOAD_SPOOL_MAX_BYTES = 8 * 1024 * 1024  # Slack downloads are held in memory up to this size, then spill to a temp file
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Uploads already within the limits above are base64-encoded as they stream in. A multiple of 3 bytes,
+# so each full chunk encodes to whole base64 quanta without carrying bytes over to the next one.
+BASE64_STREAM_CHUNK_SIZE = 57 * 1024
+# --- End Images Configuration ---
+
+# --- Configuration for Public Image URLs ---
+# When enabled, uploaded images are made public with files.sharedPublicURL and OpenAI fetches them by URL,
+# instead of the bot downloading them and sending them base64-encoded. This makes each reviewed file
+# reachable by anyone with the link until the review finishes, when the bot revokes the links it created
+# (files it finds already public are left public). Slack only allows user tokens (files:write) to call these methods.
+# Any failure falls back to the download + base64 path.
+SEND_PUBLIC_IMAGE_URLS = os.environ.get("SEND_PUBLIC_IMAGE_URLS", "false").lower() == "true"
+# If the example images directory is also served over HTTPS, OpenAI can fetch the examples from there
+# (EXAMPLE_IMAGES_BASE_URL + file name) instead of receiving them base64-encoded in every request.
+# The hosted files are sent as-is, so they should already be within EXAMPLE_MAX_SIDE.
+EXAMPLE_IMAGES_BASE_URL = os.environ.get("EXAMPLE_IMAGES_BASE_URL", "").rstrip("/")
+# --- End Public Image URLs Configuration ---
+
+# --- Review Prompt ---
+MAIN_PROMPT_INSTRUCTIONS = """
+                    You are a creative performance analyst evaluating mobile or desktop ad creatives.
+                    Your task:
+                    1. Estimate a creative score from 0–100 based on likely ad performance
+                    2. Highlight 1–2 visual strengths
+                    3. Call out 1–2 weaknesses
+                    4. Suggest 2–3 specific improvements
+                    5. Summarize the image data that informed your decision
+                    Be concise but human. Focus on clarity, visual hierarchy, and user impact—not just aesthetics.
+                    ---
+                    Please review and score this image based on its visual characteristics
+                    Respond in this exact format:
+                    --> Score: ##/100
+                    --> Strengths:
+                    • [1-line bullet]
+                    • [Optional 2nd bullet]
+                    -->  Weaknesses:
+                    • [1-line bullet]
+                    • [Optional 2nd bullet]
+                    --> Suggestions:
+                    • [Change 1]
+                    • [Change 2]
+                    • [Optional Change 3]
+                    --> Image Data Summary:
+                    ---
+                    """
+# Shared by every review request; the SDK only serializes it, so one dict can be reused
+_SYSTEM_PROMPT_MESSAGE = {"role": "system", "content": MAIN_PROMPT_INSTRUCTIONS}
+# Fixed content parts of the example block; shared across prompts, so treat them as read-only
+_HISTORIC_HEADER_PART = {"type": "text", "text": "Historic Data for scoring:"}
+_NO_EXAMPLES_PART = {"type": "text", "text": "Historic Data for scoring:\n• No example data was available for this review."}
+# Label before the uploaded image in a single review; only the image_url part after it changes per request
+_IMAGE_TO_REVIEW_PART = {"type": "text", "text": "Image to review:"}
+# Marks the start of each image's review when several uploads are reviewed in one OpenAI call
+BATCH_REVIEW_MARKER = "=== Review for Uploaded Image {} ==="
+_BATCH_REVIEW_MARKER_RE = re.compile(r"^[#*\s]*=== Review for Uploaded Image (\d+) ===[*\s]*$", re.MULTILINE)
+# --- End Review Prompt ---
+
+# --- Review Batching ---
+# Uploads arriving within this window share one OpenAI call (and one copy of the example images)
+REVIEW_BATCH_WINDOW_SECONDS = float(os.environ.get("REVIEW_BATCH_WINDOW_SECONDS", "0.5"))
+REVIEW_BATCH_MAX_SIZE = int(os.environ.get("REVIEW_BATCH_MAX_SIZE", "4"))  # Max uploaded images per OpenAI call
+# Labels before each uploaded image in a batched review, built once like the other fixed prompt parts
+_UPLOADED_IMAGE_LABEL_PARTS = tuple(
+    {"type": "text", "text": f"Uploaded Image {image_number}:"} for image_number in range(1, REVIEW_BATCH_MAX_SIZE + 1)
+)
+_review_queue = asyncio.Queue()  # Holds (file_id, image_url, on_text, future) awaiting review
+_review_batcher_task = None
+_review_batch_tasks = set()  # Strong references to in-flight batches so they aren't garbage collected
+# --- End Review Batching ---
+
+# --- Review Streaming ---
+# Single-image reviews are posted while GPT-4o is still writing them and edited in place as text arrives.
+# Slack allows roughly one chat.update per second per message.
+REVIEW_STREAM_UPDATE_SECONDS = 1.0
+# --- End Review Streaming ---
+
+# --- Cached Example Prompt Block ---
+_static_example_block = None  # Content parts for the currently selected examples, shared by every review
+_static_example_block_built_at = 0.0
+_static_example_block_source = None  # The _EXAMPLE_CACHE list the block was sampled from; a reload re-samples
+# Review batches build the block in worker threads; one rebuild at a time, and the rest reuse its result
+_static_example_block_lock = threading.Lock()
+# --- End Cached Example Prompt Block ---
+
 # --- Globals for Event Deduplication ---
-PROCESSED_EVENT_IDS = set()
 MAX_EVENT_ID_AGE_SECONDS = 300  # 5 minutes, adjust as needed
-EVENT_ID_TIMESTAMPS = {} # Stores event_id: arrival_time
+# Hard cap on remembered IDs per dedup cache, so a burst within the TTL can't grow memory without bound
+EVENT_CACHE_SIZE = int(os.environ.get("EVENT_CACHE_SIZE", "4096"))
+_PROCESSED_EVENTS = OrderedDict()  # Stores event_id: arrival_time, oldest first
+# Optional SQLite file that also records claimed IDs, so Slack retries arriving just after a restart are still skipped
+EVENT_CACHE_DB = os.environ.get("EVENT_CACHE_DB")
+_event_cache_db = None
 # --- End Globals for Event Deduplication ---
 
 # --- Globals for Mention-Processed File Deduplication ---
-MENTION_PROCESSED_FILE_IDS = set()
-MENTION_FILE_ID_TIMESTAMPS = {}
+_MENTION_PROCESSED_FILES = OrderedDict()  # Stores file_id: mention_time, oldest first
 MAX_MENTION_FILE_ID_AGE_SECONDS = 60  # 1 minute, adjust as needed
 # --- End Globals for Mention-Processed File Deduplication ---
 
-def get_example_context_data(logger):
-    """Fetches 'n' example images and their performance data."""
+# --- Globals for In-Flight File Processing ---
+_inflight_files = {}  # Stores file_id: (Future resolved with the review once the first caller finishes, its channel_id, its thread_ts)
+INFLIGHT_FILE_TTL_SECONDS = 60  # How long a finished result keeps absorbing duplicate calls
+# --- End Globals for In-Flight File Processing ---
+
+# --- Cache of Finished Reviews ---
+# Re-mentioning the same file shortly afterwards re-posts its review instead of paying for another OpenAI call
+_REVIEW_CACHE = OrderedDict()  # Stores file_id: (cached_at, file_name, review), oldest first
+REVIEW_CACHE_TTL_SECONDS = 15 * 60
+REVIEW_CACHE_MAX_ENTRIES = 256
+# --- End Cache of Finished Reviews ---
+
+# --- Bot Identity ---
+# Filled in once at startup from auth.test; handlers fall back to the event's authorizations until then
+_BOT_USER_ID = None
+_BOT_MENTION = None  # "<@BOT_USER_ID>", the substring Slack puts in message text when the bot is mentioned
+# --- End Bot Identity ---
+
+# --- Cache of Prepared Examples ---
+# Every example listed in the CSV is read, downscaled and base64-encoded once; requests only sample from this list.
+_EXAMPLE_CACHE = None  # List of {"filename", "performance_info", "data_uri", "image_part"} dicts
+_EXAMPLE_CACHE_MTIMES = None  # (CSV mtime, images directory mtime) the cache was built from; a change triggers a reload
+PREWARM_MAX_WORKERS = 8  # Threads used to read and encode example images
+# Image types the OpenAI vision API accepts, keyed by file extension
+_EXT_TO_MIME = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif', '.webp': 'image/webp'}
+# Leading bytes of each image type OpenAI accepts, for uploads whose real type Slack may mislabel.
+# WebP is checked separately: its RIFF magic is split around a 4-byte size field.
+_MIME_BY_MAGIC = {
+    b"\xff\xd8\xff": "image/jpeg",
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+}
+# --- End Cache of Prepared Examples ---
+
+def _sniff_mime(header):
+    """Returns the MIME type implied by an image's first 12 bytes, or None if it isn't a type OpenAI accepts."""
+    for magic, mime_type in _MIME_BY_MAGIC.items():
+        if header[:len(magic)] == magic:
+            return mime_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def _load_example_performance_csv(path):
+    """Parses the pipe-separated example performance CSV into (column_names, rows).
+    Only called when _load_examples_once rebuilds its cache, so the result isn't cached here."""
+    # The CSV is UTF-8 (possibly with a BOM from a spreadsheet export); open() alone would use the locale's encoding
+    with open(path, newline='', encoding='utf-8-sig') as csv_file:
+        reader = csv.DictReader(csv_file, delimiter='|')
+        rows = list(reader)
+    return reader.fieldnames or [], rows
+
+def _fit_image_for_review(image_file, num_bytes, mime_type, max_side=DOWNSCALE_MAX_SIDE):
+    """Reads an image from a binary file object, returning (image_bytes, mime_type, downscaled); image_bytes may be a memoryview.
+
+    Images larger than max_side or MAX_UPLOAD_IMAGE_BYTES are downscaled and re-encoded as JPEG;
+    others are returned as-is, with PIL only parsing the header. CPU-bound, so async callers should run it in a thread.
+    """
+    pil_image = Image.open(image_file)
+    if max(pil_image.size) <= max_side and num_bytes <= MAX_UPLOAD_IMAGE_BYTES:
+        image_file.seek(0)
+        return image_file.read(), mime_type, False
+    # The re-encoded JPEG carries no EXIF, so a phone photo's orientation tag has to be applied to the pixels here.
+    # Only when the tag is set: exif_transpose always loads the full image, which would skip JPEG draft decoding.
+    if pil_image.getexif().get(0x0112, 1) != 1:
+        pil_image = ImageOps.exif_transpose(pil_image)
+    has_alpha = pil_image.mode in ("RGBA", "LA", "PA") or "transparency" in pil_image.info
+    if has_alpha:
+        # Converted before resizing so palette images are resampled properly rather than with nearest-neighbour
+        pil_image = pil_image.convert("RGBA")
+    pil_image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if has_alpha:
+        # JPEG has no alpha; dropping it would expose whatever colour sits under transparent pixels (often black).
+        # Flatten onto white, as the creative appears in Slack, so GPT-4o reviews what the user posted.
+        flattened = Image.new("RGB", pil_image.size, (255, 255, 255))
+        flattened.paste(pil_image, mask=pil_image.getchannel("A"))
+        pil_image = flattened
+    buffered = BytesIO()
+    pil_image.convert("RGB").save(buffered, format="JPEG", quality=DOWNSCALE_JPEG_QUALITY, optimize=True)
+    # getbuffer() is a zero-copy view of the JPEG, unlike getvalue(); base64 accepts it directly
+    return buffered.getbuffer(), "image/jpeg", True
+
+def _encode_example_image(image_path):
+    """Reads an example image from disk and returns it as a ready-to-send data URI."""
+    # The extension is enough to label a local example; no need to have PIL parse the image for it.
+    # A fixed table rather than the mimetypes module, whose answers depend on the host's MIME registry.
+    mime_type = _EXT_TO_MIME.get(os.path.splitext(image_path)[1].lower())
+    if mime_type is None:
+        raise ValueError(f"Unsupported example image type (expected one of {', '.join(_EXT_TO_MIME)})")
+    with open(image_path, "rb") as image_file:
+        img_bytes, mime_type, _ = _fit_image_for_review(
+            image_file, os.fstat(image_file.fileno()).st_size, mime_type, max_side=EXAMPLE_MAX_SIDE
+        )
+    # base64 output is pure ASCII, so the ASCII codec is the cheapest way to get a str
+    return f"data:{mime_type};base64,{base64.b64encode(memoryview(img_bytes)).decode('ascii')}"
+
+def _load_examples_once(logger):
+    """Returns every example from the performance CSV with its image pre-encoded, loading them on first use
+    (or after the CSV or the set of files in the images directory changes).
+    Returns an empty list if the CSV or images directory is unusable."""
+    global _EXAMPLE_CACHE, _EXAMPLE_CACHE_MTIMES
+    # Two stats per call on the cache-hit path; the images directory is only read on reload.
+    # The directory's mtime changes when images are added, removed or renamed (not when one is overwritten in place).
+    try:
+        csv_mtime = os.stat(EXAMPLE_PERFORMANCE_CSV).st_mtime
+    except FileNotFoundError:
+        logger.error(f"Example performance CSV not found at: {EXAMPLE_PERFORMANCE_CSV}")
+        return []
+    try:
+        images_dir_mtime = os.stat(EXAMPLE_IMAGES_DIR).st_mtime
+    except FileNotFoundError:
+        logger.error(f"Example images directory not found at: {EXAMPLE_IMAGES_DIR}")
+        return []
+    mtimes = (csv_mtime, images_dir_mtime)
+    if _EXAMPLE_CACHE is not None and mtimes == _EXAMPLE_CACHE_MTIMES:
+        return _EXAMPLE_CACHE
+
+    # A single directory read instead of a stat per example image. Matched case-insensitively, as the per-file
+    # existence check was on macOS/Windows, so CSV names like img_1.png still find Img_1.png.
+    try:
+        with os.scandir(EXAMPLE_IMAGES_DIR) as entries:
+            available_images = {entry.name.casefold(): entry.name for entry in entries if entry.is_file()}
+    except (FileNotFoundError, NotADirectoryError):
+        logger.error(f"Example images directory not found at: {EXAMPLE_IMAGES_DIR}")
+        return []
+
+    columns, rows = _load_example_performance_csv(EXAMPLE_PERFORMANCE_CSV)
+    if 'image_filename' not in columns or 'performance_info' not in columns:
+        logger.error(f"CSV must contain 'image_filename' and 'performance_info' columns (pipe-separated).")
+        return []
+    if len(rows) == 0:
+        logger.warning("Performance CSV is empty.")
+
+    def encode_one(row):
+        image_filename, performance_info = row['image_filename'], row['performance_info']
+        disk_filename = available_images.get(image_filename.casefold())
+        if disk_filename is None:
+            logger.warning(f"Example image file not found: {os.path.join(EXAMPLE_IMAGES_DIR, image_filename)}. Skipping.")
+            return None
+        image_path = os.path.join(EXAMPLE_IMAGES_DIR, disk_filename)
+        try:
+            data_uri = _encode_example_image(image_path)
+        except Exception as e:
+            logger.error(f"Error processing example image {image_path}: {e}")
+            return None
+        # The data URI is still built when examples are hosted: it validates the file and drives the duplicate check below
+        image_url = f"{EXAMPLE_IMAGES_BASE_URL}/{urllib.parse.quote(disk_filename)}" if EXAMPLE_IMAGES_BASE_URL else data_uri
+        return {
+            "filename": image_filename,
+            "performance_info": performance_info,
+            "data_uri": data_uri,
+            # Built once here and shared by every prompt that samples this example.
+            # Examples are only reference context, so one low-detail tile each is enough; the upload keeps the default detail.
+            "image_part": {"type": "image_url", "image_url": {"url": image_url, "detail": "low"}}
+        }
+
+    # Reads overlap on disk, and Pillow releases the GIL while decoding, resizing and re-encoding.
+    # base64 holds the GIL, but on images already downscaled to EXAMPLE_MAX_SIDE it is the cheap step.
+    with ThreadPoolExecutor(max_workers=max(1, min(PREWARM_MAX_WORKERS, len(rows)))) as executor:
+        encoded = [example for example in executor.map(encode_one, rows) if example is not None]
+
+    # Identical images (repeated CSV rows, or copies under different names) would cost the same tokens twice
+    # when sampled together; keep the first. Comparing the data URIs themselves is exact and hashes each once.
     examples = []
+    seen_data_uris = set()
+    for example in encoded:
+        if example["data_uri"] in seen_data_uris:
+            logger.warning(f"Example image {example['filename']} duplicates an earlier example. Skipping.")
+            continue
+        seen_data_uris.add(example["data_uri"])
+        examples.append(example)
+
+    _EXAMPLE_CACHE = examples
+    _EXAMPLE_CACHE_MTIMES = mtimes
+    logger.info(f"Loaded {len(examples)} examples into the cache.")
+    return examples
+
+def get_example_context_data(logger):
+    """Fetches 'n' random example images and their performance data from the cache."""
     try:
-        if not os.path.exists(EXAMPLE_PERFORMANCE_CSV):
-            logger.error(f"Example performance CSV not found at: {EXAMPLE_PERFORMANCE_CSV}")
-            return []
-        if not os.path.isdir(EXAMPLE_IMAGES_DIR):
-            logger.error(f"Example images directory not found at: {EXAMPLE_IMAGES_DIR}")
-            return []
-
-        df = pd.read_csv(EXAMPLE_PERFORMANCE_CSV, delimiter='|')
-        if 'image_filename' not in df.columns or 'performance_info' not in df.columns:
-            logger.error(f"CSV must contain 'image_filename' and 'performance_info' columns (pipe-separated).")
-            return []
-
-        if len(df) == 0:
-            logger.warning("Performance CSV is empty.")
-            return []
-
-        # Select N random examples (or first N if fewer than N available)
-        num_to_sample = min(NUM_EXAMPLES_TO_INCLUDE, len(df))
-        sampled_df = df.sample(n=num_to_sample) if len(df) >= num_to_sample else df
-
-        for _, row in sampled_df.iterrows():
-            image_filename = row['image_filename']
-            performance_info = row['performance_info']
-            image_path = os.path.join(EXAMPLE_IMAGES_DIR, image_filename)
-
-            if not os.path.exists(image_path):
-                logger.warning(f"Example image file not found: {image_path}. Skipping.")
+        examples = _load_examples_once(logger)
+        sampled = random.sample(examples, min(NUM_EXAMPLES_TO_INCLUDE, len(examples)))
+        logger.info(f"Prepared {len(sampled)} examples for context.")
+        return sampled
+    except Exception as e:
+        logger.error(f"Error preparing example context data: {e}")
+        return []
+
+# Load examples at startup so the first review doesn't pay for it
+try:
+    _load_examples_once(module_logger)
+except Exception as e:
+    module_logger.error(f"Error pre-loading example context data: {e}")
+
+def _is_retryable_download_error(exception):
+    """Slack throttling (429), server errors (5xx) and network failures are worth retrying; other 4xx are not."""
+    if isinstance(exception, httpx.HTTPStatusError):
+        status = exception.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(exception, httpx.TransportError)
+
+def _wait_for_slack_retry(retry_state):
+    """Honors Slack's Retry-After header when present, otherwise backs off exponentially with jitter.
+    Either way the wait is capped at SLACK_DOWNLOAD_MAX_WAIT_SECONDS, since the user is already waiting on the review."""
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, httpx.HTTPStatusError):
+        retry_after = exception.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), SLACK_DOWNLOAD_MAX_WAIT_SECONDS)
+    return wait_random_exponential(min=1, max=SLACK_DOWNLOAD_MAX_WAIT_SECONDS)(retry_state)
+
+@retry(
+    retry=retry_if_exception(_is_retryable_download_error),
+    wait=_wait_for_slack_retry,
+    stop=stop_after_attempt(SLACK_DOWNLOAD_MAX_ATTEMPTS),
+    before_sleep=before_sleep_log(module_logger, logging.INFO),
+    reraise=True,
+)
+async def _download_slack_file(url):
+    """Streams a private Slack file into a SpooledTemporaryFile, so memory stays bounded by DOWNLOAD_SPOOL_MAX_BYTES
+    even for very large uploads. Returns the file positioned at its end; the caller is responsible for closing it."""
+    spool = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_MAX_BYTES)
+    try:
+        async with slack_http_client.stream("GET", url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+@retry(
+    retry=retry_if_exception(_is_retryable_download_error),
+    wait=_wait_for_slack_retry,
+    stop=stop_after_attempt(SLACK_DOWNLOAD_MAX_ATTEMPTS),
+    before_sleep=before_sleep_log(module_logger, logging.INFO),
+    reraise=True,
+)
+async def _download_slack_file_as_data_uri(url, mime_type):
+    """Streams a private Slack file straight into a base64 data URI, without holding the raw bytes or a PIL copy.
+    The URI is labelled with the type sniffed from the file's first bytes, falling back to mime_type."""
+    data_uri = None
+    residue = b""  # Trailing bytes of the last chunk that didn't fill a 3-byte base64 quantum
+    async with slack_http_client.stream("GET", url) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(BASE64_STREAM_CHUNK_SIZE):
+            if data_uri is None:
+                data_uri = bytearray(b"data:" + (_sniff_mime(chunk) or mime_type).encode("ascii") + b";base64,")
+            if residue:
+                chunk = residue + chunk
+            # Only whole 3-byte groups are encoded now, so padding can only appear at the very end.
+            # Chunks normally arrive as exact multiples of 3, leaving no residue to copy.
+            aligned = len(chunk) - len(chunk) % 3
+            data_uri += base64.b64encode(memoryview(chunk)[:aligned])
+            residue = chunk[aligned:]
+    if data_uri is None:
+        data_uri = bytearray(b"data:" + mime_type.encode("ascii") + b";base64,")
+    data_uri += base64.b64encode(residue)
+    return data_uri.decode("ascii")
+
+def _estimate_request_tokens(messages, max_tokens):
+    """Rough token cost of a chat request: ~4 characters per text token, a flat cost per image, plus the completion budget."""
+    text_chars = 0
+    image_tokens = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            text_chars += len(content)
+            continue
+        for part in content:
+            if part["type"] == "image_url":
+                low_detail = part["image_url"].get("detail") == "low"
+                image_tokens += TOKENS_PER_LOW_DETAIL_IMAGE if low_detail else TOKENS_PER_IMAGE_ESTIMATE
+            else:
+                text_chars += len(part.get("text", ""))
+    return text_chars // 4 + image_tokens + max_tokens
+
+# Timeouts surface as openai.APITimeoutError, a subclass of APIConnectionError
+_retry_openai = retry(
+    retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(OPENAI_MAX_ATTEMPTS),
+    before_sleep=before_sleep_log(module_logger, logging.INFO),
+    reraise=True,
+)
+
+@_retry_openai
+async def _call_openai(messages, max_tokens=OPENAI_MAX_TOKENS):
+    """Sends a review request to GPT-4o, retrying transient failures. The concurrency slot is only held per attempt."""
+    await _openai_rate_limiter.acquire(_estimate_request_tokens(messages, max_tokens))
+    async with _openai_sem:
+        return await openai_client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=max_tokens
+        )
+
+@_retry_openai
+async def _stream_openai(messages, on_text, max_tokens=OPENAI_MAX_TOKENS):
+    """Like _call_openai, but streams the completion and returns its full text. on_text is awaited with the
+    text so far at most every REVIEW_STREAM_UPDATE_SECONDS; a retry starts the text over."""
+    await _openai_rate_limiter.acquire(_estimate_request_tokens(messages, max_tokens))
+    async with _openai_sem:
+        stream = await openai_client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        pieces = []
+        last_update = time.monotonic()
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
                 continue
+            pieces.append(chunk.choices[0].delta.content)
+            now = time.monotonic()
+            if now - last_update >= REVIEW_STREAM_UPDATE_SECONDS:
+                last_update = now
+                await on_text("".join(pieces))
+        return "".join(pieces)
 
+def _build_example_context_parts(example_contexts, logger):
+    """Builds the 'Historic Data' content parts that precede the uploaded image(s) in a review prompt."""
+    if not example_contexts:
+        logger.warning("No example contexts found for image review.")
+        return (_NO_EXAMPLES_PART,)
+
+    # Every entry must be a content part; each example is a text part followed by its image
+    example_parts = [_HISTORIC_HEADER_PART]
+    for i, ex_data in enumerate(example_contexts):
+        example_parts.append({
+            "type": "text",
+            "text": f"--- Example {i+1} (Filename: {ex_data['filename']}) ---\nPerformance Info: {ex_data['performance_info']}\n--- End Example {i+1} ---"
+        })
+        example_parts.append(ex_data["image_part"])
+    # A tuple, since the block is shared by every prompt built until the next re-sample
+    return tuple(example_parts)
+
+def _get_static_example_block():
+    """Returns the cached example content parts, re-sampling the examples every EXAMPLE_SELECTION_REFRESH_SECONDS
+    or as soon as the example cache is reloaded (the CSV or the set of images changed)."""
+    global _static_example_block, _static_example_block_built_at, _static_example_block_source
+    with _static_example_block_lock:
+        now = time.monotonic()
+        try:
+            # Two stats when nothing changed; returns a new list only after a reload
+            examples = _load_examples_once(module_logger)
+        except Exception as e:
+            module_logger.error(f"Error checking example context data for changes: {e}")
+            examples = _static_example_block_source
+        if (
+            _static_example_block is None
+            or examples is not _static_example_block_source
+            or now - _static_example_block_built_at > EXAMPLE_SELECTION_REFRESH_SECONDS
+        ):
+            block = _build_example_context_parts(get_example_context_data(module_logger), module_logger)
+            if block == (_NO_EXAMPLES_PART,):
+                # Not cached: a missing res/ or a CSV caught mid-edit shouldn't strip the examples for a whole hour
+                return block
+            _static_example_block = block
+            _static_example_block_built_at = now
+            _static_example_block_source = examples
+        return _static_example_block
+
+def _build_review_messages(example_parts, per_request_parts):
+    """Orders a review request so the parts identical across requests (instructions, then examples) form the prefix.
+
+    OpenAI caches the longest matching prompt prefix, so anything specific to this request goes last.
+    """
+    return [
+        _SYSTEM_PROMPT_MESSAGE,
+        {"role": "user", "content": [*example_parts, *per_request_parts]}
+    ]
+
+async def _review_single_image(image_url, example_parts, on_text=None):
+    """Reviews one uploaded image against the shared example context, streaming partial text to on_text if given."""
+    messages = _build_review_messages(example_parts, [_IMAGE_TO_REVIEW_PART, {"type": "image_url", "image_url": {"url": image_url}}])
+    if on_text is not None:
+        return await _stream_openai(messages, on_text)
+    chat_completion = await _call_openai(messages)
+    return chat_completion.choices[0].message.content
+
+def _split_batched_reviews(response_text):
+    """Splits a multi-image response on BATCH_REVIEW_MARKER lines into {image_number: review}."""
+    pieces = _BATCH_REVIEW_MARKER_RE.split(response_text)
+    # pieces is [preamble, number_1, review_1, number_2, review_2, ...]
+    return {int(number): review.strip() for number, review in zip(pieces[1::2], pieces[2::2]) if review.strip()}
+
+async def _review_images_together(image_urls, example_parts):
+    """Reviews several uploaded images in one OpenAI call, sending the example images only once."""
+    num_images = len(image_urls)
+    per_request_parts = [
+        {"type": "text", "text": (
+            f"There are {num_images} separate uploaded images below. Review each one independently. "
+            f"Begin each review with the line '{BATCH_REVIEW_MARKER.format('N')}' (N = 1 to {num_images}), "
+            f"followed by the exact format from the instructions."
+        )}
+    ]
+    for label_part, image_url in zip(_UPLOADED_IMAGE_LABEL_PARTS, image_urls):
+        per_request_parts.append(label_part)
+        per_request_parts.append({"type": "image_url", "image_url": {"url": image_url}})
+
+    chat_completion = await _call_openai(
+        _build_review_messages(example_parts, per_request_parts),
+        max_tokens=OPENAI_MAX_TOKENS * num_images
+    )
+    return _split_batched_reviews(chat_completion.choices[0].message.content)
+
+async def _run_review_batch(batch):
+    """Reviews one window of queued uploads and resolves each caller's future with its own review."""
+    try:
+        # Off the event loop: a changed CSV means re-encoding every example image
+        example_parts = await asyncio.to_thread(_get_static_example_block)
+    except Exception as e:
+        module_logger.error(f"Error preparing example context for review batch: {e}")
+        for _, _, _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+
+    reviews = {}
+    if len(batch) > 1:
+        try:
+            reviews = await _review_images_together([image_url for _, image_url, _, _ in batch], example_parts)
+            if len(reviews) < len(batch):
+                module_logger.warning(f"Batched review returned {len(reviews)} of {len(batch)} reviews; reviewing the rest individually.")
+        except Exception as e:
+            module_logger.error(f"Batched review of {len(batch)} images failed; reviewing them individually: {e}")
+
+    async def resolve(image_number, file_id, image_url, on_text, future):
+        try:
+            review = reviews.get(image_number)
+            if review is None:
+                review = await _review_single_image(image_url, example_parts, on_text)
+            if not future.done():
+                future.set_result(review)
+        except Exception as e:
+            module_logger.error(f"Error reviewing file {file_id}: {e}")
+            if not future.done():
+                future.set_exception(e)
+
+    await asyncio.gather(*(
+        resolve(image_number, file_id, image_url, on_text, future)
+        for image_number, (file_id, image_url, on_text, future) in enumerate(batch, start=1)
+    ))
+
+async def _review_batcher():
+    """Collects queued uploads for up to REVIEW_BATCH_WINDOW_SECONDS and dispatches each window as one batch."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _review_queue.get()]
+        deadline = loop.time() + REVIEW_BATCH_WINDOW_SECONDS
+        while len(batch) < REVIEW_BATCH_MAX_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
             try:
-                with open(image_path, "rb") as image_file:
-                    img_bytes = image_file.read()
-                    pil_image = Image.open(BytesIO(img_bytes))
-                    img_format = pil_image.format.lower()
-                    
-                    mime_type = f"image/{img_format}"
-                    if img_format == 'jpg': mime_type = "image/jpeg"
-                    # Add more specific mimetypes if needed, or rely on common ones
-
-                    base64_image = base64.b64encode(img_bytes).decode("utf-8")
-                    examples.append({
-                        "filename": image_filename,
-                        "performance_info": performance_info,
-                        "base64_image": base64_image,
-                        "mime_type": mime_type
-                    })
+                batch.append(await asyncio.wait_for(_review_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        if len(batch) > 1:
+            module_logger.info(f"Reviewing {len(batch)} uploaded images in one OpenAI call.")
+        # Dispatch without awaiting so the next window can start filling while this one is in flight
+        task = asyncio.create_task(_run_review_batch(batch))
+        _review_batch_tasks.add(task)
+        task.add_done_callback(_review_batch_tasks.discard)
+
+async def request_review(file_id, image_url, on_text=None):
+    """Queues an uploaded image for review and waits for the result.
+
+    on_text, if given, is awaited with partial review text while the review streams. Images reviewed
+    together in a batched call aren't streamed, since their reviews only separate once the response is complete.
+    """
+    global _review_batcher_task
+    if _review_batcher_task is None or _review_batcher_task.done():
+        _review_batcher_task = asyncio.create_task(_review_batcher())
+    future = asyncio.get_running_loop().create_future()
+    await _review_queue.put((file_id, image_url, on_text, future))
+    return await future
+
+
+def _expire_oldest(entries, max_age_seconds, current_time):
+    """Drops entries older than max_age_seconds from an id -> timestamp OrderedDict kept in insertion order.
+    Only the expired entries at the front are visited, so this is amortized O(1) per event."""
+    while entries and current_time - next(iter(entries.values())) > max_age_seconds:
+        entries.popitem(last=False)
+
+def _mark_processed(entries, key, current_time):
+    """Records key as seen now, moving it to the newest end so _expire_oldest can stop at the first fresh entry."""
+    entries[key] = current_time
+    entries.move_to_end(key)
+
+def _remember(entries, key, max_age_seconds, current_time, max_entries=EVENT_CACHE_SIZE):
+    """Records key as seen now, whether or not it was already there, expiring old entries and capping the size."""
+    _expire_oldest(entries, max_age_seconds, current_time)
+    _mark_processed(entries, key, current_time)
+    while len(entries) > max_entries:
+        entries.popitem(last=False)
+
+def _claim(entries, key, max_age_seconds, current_time, max_entries=EVENT_CACHE_SIZE, kind=None):
+    """Atomically checks and records key, returning False if it was already seen within max_age_seconds.
+    Beyond max_entries the oldest IDs are forgotten early, even if they are still within max_age_seconds.
+    With EVENT_CACHE_DB set, keys claimed under a kind are also checked against (and recorded in) the database.
+
+    Handlers run on the event loop, so this is safe without a lock only because it never awaits;
+    keep the check and the insert together here rather than splitting them around an await.
+    """
+    _expire_oldest(entries, max_age_seconds, current_time)
+    if key in entries:
+        return False
+    _remember(entries, key, max_age_seconds, current_time, max_entries)
+    if kind is not None and _event_cache_db is not None:
+        return _claim_persisted(kind, key, max_age_seconds)
+    return True
+
+def _open_event_cache_db(path):
+    """Opens (creating if needed) the SQLite table of claimed IDs."""
+    db = sqlite3.connect(path, isolation_level=None)  # Autocommit; each claim is a single statement pair
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")  # WAL + NORMAL: durable across app crashes, commits without an fsync
+    db.execute("CREATE TABLE IF NOT EXISTS seen (kind TEXT NOT NULL, key TEXT NOT NULL, ts REAL NOT NULL, PRIMARY KEY (kind, key))")
+    db.execute("CREATE INDEX IF NOT EXISTS seen_ts ON seen (ts)")
+    return db
+
+def _claim_persisted(kind, key, max_age_seconds):
+    """Records key in EVENT_CACHE_DB, returning False if it was claimed there within max_age_seconds
+    (possibly by a previous run). Database errors are logged and treated as a successful claim."""
+    now = time.time()  # Wall clock, since entries have to outlive this process
+    try:
+        _event_cache_db.execute("DELETE FROM seen WHERE kind = ? AND ts < ?", (kind, now - max_age_seconds))
+        cursor = _event_cache_db.execute("INSERT OR IGNORE INTO seen (kind, key, ts) VALUES (?, ?, ?)", (kind, key, now))
+        return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        module_logger.warning(f"Event cache database error; continuing without it for {kind} {key}: {e}")
+        return True
+
+if EVENT_CACHE_DB:
+    try:
+        _event_cache_db = _open_event_cache_db(EVENT_CACHE_DB)
+    except sqlite3.Error as e:
+        module_logger.error(f"Could not open event cache database {EVENT_CACHE_DB}; deduplicating in memory only: {e}")
+
+def _get_cached_review(file_id, current_time):
+    """Returns (file_name, review) for a file reviewed within REVIEW_CACHE_TTL_SECONDS, or None."""
+    while _REVIEW_CACHE and current_time - next(iter(_REVIEW_CACHE.values()))[0] > REVIEW_CACHE_TTL_SECONDS:
+        _REVIEW_CACHE.popitem(last=False)
+    cached = _REVIEW_CACHE.get(file_id)
+    return cached[1:] if cached is not None else None
+
+def _cache_review(file_id, file_name, review, current_time):
+    """Remembers a finished review, evicting the oldest beyond REVIEW_CACHE_MAX_ENTRIES."""
+    _REVIEW_CACHE[file_id] = (current_time, file_name, review)
+    _REVIEW_CACHE.move_to_end(file_id)
+    while len(_REVIEW_CACHE) > REVIEW_CACHE_MAX_ENTRIES:
+        _REVIEW_CACHE.popitem(last=False)
+
+async def _get_public_image_url(file_id, file_data, logger):
+    """Returns (url, shared_by_bot): a direct, publicly fetchable URL for a Slack image, sharing it publicly first
+    if needed, and whether this call did the sharing (so it should be revoked after the review). (None, False) on failure."""
+    shared_by_bot = False
+    try:
+        if not file_data.get("public_url_shared"):
+            share_response = await app.client.files_sharedPublicURL(file=file_id, token=SLACK_USER_TOKEN)
+            shared_by_bot = True
+            file_data = share_response["file"]
+        # permalink_public ends in the file's pub_secret, which unlocks url_private without auth
+        pub_secret = file_data["permalink_public"].rsplit("-", 1)[-1]
+        return f"{file_data['url_private']}?pub_secret={pub_secret}", shared_by_bot
+    except Exception as e:
+        logger.warning(f"Could not get a public URL for file {file_id}; sending it base64-encoded instead: {e}")
+        if shared_by_bot:
+            await _revoke_public_image_url(file_id, logger)
+        return None, False
+
+async def _revoke_public_image_url(file_id, logger):
+    """Turns off a public link the bot created, once OpenAI no longer needs to fetch the image."""
+    try:
+        await app.client.files_revokePublicURL(file=file_id, token=SLACK_USER_TOKEN)
+        logger.info(f"Revoked the public URL of file {file_id}.")
+    except Exception as e:
+        logger.error(f"Could not revoke the public URL of file {file_id}; it is still publicly accessible: {e}")
+
+async def _prepare_image_url(file_id, file_data, file_url_private, slack_mimetype, logger):
+    """Returns (image_url, revoke_after_review): the URL OpenAI should fetch the uploaded image from (a public link,
+    or a base64 data URI of the download) and whether that public link was created by the bot and must be revoked."""
+    image_url = None
+    if SEND_PUBLIC_IMAGE_URLS:
+        image_url, shared_by_bot = await _get_public_image_url(file_id, file_data, logger)
+        if image_url is not None:
+            return image_url, shared_by_bot
+
+    # Slack reports the upload's size and dimensions, so uploads that need no downscaling skip PIL entirely
+    fits_as_is = (
+        0 < file_data.get("size", 0) <= MAX_UPLOAD_IMAGE_BYTES
+        and 0 < max(int(file_data.get("original_w") or 0), int(file_data.get("original_h") or 0)) <= DOWNSCALE_MAX_SIDE
+    )
+    if fits_as_is:
+        image_url = await _download_slack_file_as_data_uri(file_url_private, slack_mimetype)
+    else:
+        # OpenAI accepts the original bytes; only oversized uploads are downscaled (off the event loop)
+        with await _download_slack_file(file_url_private) as spool:
+            downloaded_size = spool.tell()
+            spool.seek(0)
+            # The file's magic bytes are more reliable than Slack's mimetype, which can follow the file name
+            sniffed_mimetype = _sniff_mime(spool.read(12)) or slack_mimetype
+            spool.seek(0)
+            uploaded_image_bytes, uploaded_image_mimetype, downscaled = await asyncio.to_thread(
+                _fit_image_for_review, spool, downloaded_size, sniffed_mimetype
+            )
+        if downscaled:
+            logger.info(f"Downscaled uploaded image {file_id} from {downloaded_size} to {len(uploaded_image_bytes)} bytes before review.")
+
+        base64_uploaded_image = base64.b64encode(memoryview(uploaded_image_bytes)).decode("ascii")
+        image_url = f"data:{uploaded_image_mimetype};base64,{base64_uploaded_image}"
+    return image_url, False
+
+async def _post_cached_review(file_id, user_id, channel_id, thread_ts, say, logger):
+    """Re-posts a review from _REVIEW_CACHE into the given thread. Returns False if the file has no cached review."""
+    cached = _get_cached_review(file_id, time.monotonic())
+    if cached is None:
+        return False
+    file_name, review = cached
+    logger.info(f"File {file_id} was reviewed recently; re-posting that review instead of calling OpenAI again.")
+    await say(text=f"<@{user_id}>, here's the review for your image {file_name}:\n{review}", channel=channel_id, thread_ts=thread_ts)
+    return True
+
+async def _process_shared_file(file_id, user_id, channel_id, thread_ts, say, logger, event_file=None):
+    """Processes a shared file once. Concurrent calls for the same file wait for the first one instead of repeating
+    the download and OpenAI review, then get its review in their own thread; its future stays registered
+    for INFLIGHT_FILE_TTL_SECONDS after it finishes."""
+    # Checked first, so a finished review is re-posted for as long as it is cached, not only while its future is registered
+    if await _post_cached_review(file_id, user_id, channel_id, thread_ts, say, logger):
+        return
+
+    inflight = _inflight_files.get(file_id)
+    if inflight is not None:
+        future, first_channel_id, first_thread_ts = inflight
+        logger.info(f"File {file_id} is already being processed; waiting for that result instead of reviewing it again.")
+        await future
+        if (channel_id, thread_ts) == (first_channel_id, first_thread_ts):
+            return
+        # The first caller's reply went to its own thread; this mention still needs an answer here
+        if not await _post_cached_review(file_id, user_id, channel_id, thread_ts, say, logger):
+            # No review came out of it (not an image, or the review failed), so handle this mention on its own
+            await _review_shared_file(file_id, user_id, channel_id, thread_ts, say, logger, event_file)
+        return
+
+    loop = asyncio.get_running_loop()
+    inflight = loop.create_future()
+    _inflight_files[file_id] = (inflight, channel_id, thread_ts)
+    review = None
+    try:
+        review = await _review_shared_file(file_id, user_id, channel_id, thread_ts, say, logger, event_file)
+    finally:
+        inflight.set_result(review)
+        loop.call_later(INFLIGHT_FILE_TTL_SECONDS, _inflight_files.pop, file_id, None)
+
+def _is_complete_event_file(event_file):
+    """Whether a file object from an event carries everything a review needs, so files.info can be skipped.
+    Slack sends a stub marked file_access=check_file_info when the bot has to ask for the details itself."""
+    return (
+        bool(event_file)
+        and event_file.get("file_access", "visible") == "visible"
+        and bool(event_file.get("mimetype"))
+        and bool(event_file.get("url_private_download"))
+    )
+
+async def _review_shared_file(file_id, user_id, channel_id, thread_ts, say, logger, event_file=None):
+    """Fetches a shared file, reviews it if it is an image, and replies in the given thread.
+    Uses the event's own file object when it is complete, saving a files.info call.
+    Returns the review text, or None if no review was posted."""
+    try:
+        if _is_complete_event_file(event_file):
+            file_data = event_file
+        else:
+            file_info_response = await app.client.files_info(file=file_id)
+            if not file_info_response.get("ok"):
+                logger.error(f"Failed to get file info for {file_id}: {file_info_response.get('error')}")
+                await say(text=f"Sorry <@{user_id}>, I couldn't retrieve information about the file you shared with your mention.", channel=channel_id, thread_ts=thread_ts)
+                return
+            file_data = file_info_response.get("file")
+
+        slack_mimetype = file_data.get("mimetype", "").lower()
+        file_url_private = file_data.get("url_private_download")
+
+        if slack_mimetype.startswith("image/"):
+            logger.info(f"Processing uploaded image: {file_data.get('name')} ({slack_mimetype}) from app_mention.")
+
+            if not file_url_private:
+                logger.error(f"Private download URL not found for the image {file_id} in app_mention.")
+                await say(text=f"Sorry <@{user_id}>, I couldn't access the image file you shared with your mention.", channel=channel_id, thread_ts=thread_ts)
+                return
+
+            # Start the download before posting the acknowledgement so the two overlap, but only await its result
+            # afterwards: any download error is then reported after the acknowledgement, never before or alongside it
+            prepare_task = asyncio.create_task(_prepare_image_url(file_id, file_data, file_url_private, slack_mimetype, logger))
+            try:
+                await say(text=f"Thanks <@{user_id}>! I've received your image with your mention. Analyzing it with contextual examples...", channel=channel_id, thread_ts=thread_ts)
+            except Exception:
+                prepare_task.cancel()
+                try:
+                    _, revoke_after_review = await prepare_task
+                except (asyncio.CancelledError, Exception):
+                    revoke_after_review = False
+                # The task may have finished (and shared the file publicly) before it could be cancelled
+                if revoke_after_review:
+                    await _revoke_public_image_url(file_id, logger)
+                raise
+            image_url, revoke_after_review = await prepare_task
+
+            review_header = f"<@{user_id}>, here's the review for your image {file_data.get('name')}:\n"
+            review_ts = None
+
+            async def show_review(text):
+                """Posts the review message the first time, then edits that same message."""
+                nonlocal review_ts
+                if review_ts is None:
+                    response = await say(text=text, channel=channel_id, thread_ts=thread_ts)
+                    review_ts = response["ts"]
+                else:
+                    await app.client.chat_update(channel=channel_id, ts=review_ts, text=text)
+
+            async def show_partial_review(partial_review):
+                try:
+                    await show_review(f"{review_header}{partial_review} …")
+                except Exception as e:
+                    logger.warning(f"Could not post partial review for file {file_id}: {e}")
+
+            try:
+                review = await request_review(file_id, image_url, show_partial_review)
             except Exception as e:
-                logger.error(f"Error processing example image {image_path}: {e}")
-        
-        logger.info(f"Prepared {len(examples)} examples for context.")
-        return examples
+                logger.error(f"Error calling OpenAI API during app_mention: {e}")
+                # Replaces any partial review already posted
+                await show_review(f"Sorry <@{user_id}>, I encountered an error with the AI review for the image in your mention.")
+                return
+            finally:
+                # OpenAI has fetched the image by now; the file shouldn't stay public any longer than that
+                if revoke_after_review:
+                    await _revoke_public_image_url(file_id, logger)
 
+            # Cached before delivery, so a Slack failure below doesn't cost a second OpenAI call on the next mention
+            _cache_review(file_id, file_data.get('name'), review, time.monotonic())
+            try:
+                await show_review(review_header + review)
+            except Exception as e:
+                # chat.update is rate-limited per workspace; don't leave the user with a truncated partial review
+                logger.warning(f"Could not edit the review message for file {file_id}; posting the full review as a new message: {e}")
+                await say(text=review_header + review, channel=channel_id, thread_ts=thread_ts)
+            return review
+        else:
+            logger.info(f"File {file_id} shared with app_mention by {user_id} is not an image: {slack_mimetype}. Replying with help text.")
+            await say(text=f"Hi <@{user_id}>! You mentioned me with a file, but I can only process image files. Please try mentioning me with an image.", channel=channel_id, thread_ts=thread_ts)
+    except httpx.HTTPError as e:
+        logger.error(f"Error downloading file {file_id} from app_mention: {e}")
+        await say(text=f"Sorry <@{user_id}>, I had trouble downloading the file you shared with your mention.", channel=channel_id, thread_ts=thread_ts)
     except Exception as e:
-        logger.error(f"Error preparing example context data: {e}")
-        return []
+        logger.error(f"Error processing file {file_id} from app_mention: {e}")
+        await say(text=f"Sorry <@{user_id}>, an unexpected error occurred while processing the file in your mention.", channel=channel_id, thread_ts=thread_ts)
 
 # @app.event("file_shared")
-def handle_file_shared_events(body, say, logger):
-    current_time = time.time()
+async def handle_file_shared_events(body, event, say, logger):
+    current_time = time.monotonic()  # Front-only expiry relies on timestamps never going backwards
     event_id = body.get("event_id")
 
     # --- Deduplication Logic ---
-    # Clean up old event IDs from cache
-    expired_ids = [
-        eid for eid, ts in list(EVENT_ID_TIMESTAMPS.items()) 
-        if current_time - ts > MAX_EVENT_ID_AGE_SECONDS
-    ]
-    for eid in expired_ids:
-        PROCESSED_EVENT_IDS.discard(eid)
-        if eid in EVENT_ID_TIMESTAMPS: # Check existence before del
-            del EVENT_ID_TIMESTAMPS[eid]
-
     if event_id:
-        if event_id in PROCESSED_EVENT_IDS:
+        if not _claim(_PROCESSED_EVENTS, event_id, MAX_EVENT_ID_AGE_SECONDS, current_time, kind="event"):
             logger.info(f"handle_file_shared_events: Ignoring duplicate event_id: {event_id}")
             return
-        PROCESSED_EVENT_IDS.add(event_id)
-        EVENT_ID_TIMESTAMPS[event_id] = current_time
     else:
         # If no event_id, we can't deduplicate based on it. Proceed with caution.
         logger.warning("handle_file_shared_events: Event is missing an event_id. Cannot perform deduplication for this event.")
     # --- End Deduplication Logic ---
 
-    event = body.get("event", {})
     user_id = event.get("user_id")
     file_id = event.get("file_id") # file_id from the file_shared event
     channel_id = event.get("channel_id")
     original_event_ts = event.get("event_ts") # TS of the file_shared event itself
 
-    # --- Deduplication for files already handled by app_mention ---
-    # Clean up old mention-processed file IDs first
-    expired_mention_file_ids = [
-        fid for fid, ts in list(MENTION_FILE_ID_TIMESTAMPS.items())
-        if current_time - ts > MAX_MENTION_FILE_ID_AGE_SECONDS
-    ]
-    for fid in expired_mention_file_ids:
-        MENTION_PROCESSED_FILE_IDS.discard(fid)
-        if fid in MENTION_FILE_ID_TIMESTAMPS:
-            del MENTION_FILE_ID_TIMESTAMPS[fid]
+    # Check if the bot itself shared the file
+    bot_user_id, _ = _bot_identity(body)
+    if bot_user_id and user_id == bot_user_id:
+        logger.info(f"File {file_id} (Event ID: {event_id}) was shared by the bot itself ({user_id}). Ignoring event.")
+        return
 
-    if file_id and file_id in MENTION_PROCESSED_FILE_IDS:
+    # --- Deduplication for files already handled by app_mention ---
+    # A lookup plus an age check is enough here; the mention handler expires old entries when it claims new ones
+    mentioned_at = _MENTION_PROCESSED_FILES.get(file_id) if file_id else None
+    if mentioned_at is not None and current_time - mentioned_at <= MAX_MENTION_FILE_ID_AGE_SECONDS:
         logger.info(f"handle_file_shared_events: File {file_id} (Event ID: {event_id}) was recently processed by app_mention. Skipping.")
         return
     # --- End Mention-Processed File Deduplication ---
 
     logger.info(f"File shared event (ID: {event_id}, no mention detected by this handler): User '{user_id}', File '{file_id}', Channel '{channel_id}', Original TS '{original_event_ts}'")
 
-    # Check if the bot itself shared the file
-    authorizations = body.get("authorizations", [])
-    if authorizations and len(authorizations) > 0:
-        bot_user_id_from_auth = authorizations[0].get("user_id")
-        if user_id == bot_user_id_from_auth:
-            logger.info(f"File {file_id} (Event ID: {event_id}) was shared by the bot itself ({user_id}). Ignoring event.")
-            return
-
     # Check for missing critical information for sending a reply
     if not all([user_id, file_id, channel_id, original_event_ts]):
         logger.error(
@@ -179,7 +1061,7 @@ def handle_file_shared_events(body, say, logger):
         # Attempt a non-threaded reply if only original_event_ts is the main issue but others are okay for a general message
         if channel_id and user_id and file_id: 
             try:
-                say(
+                await say(
                     channel=channel_id,
                     text=f"Hi <@{user_id}>, I noticed you uploaded file. " 
                          f"If you want me to review it, please @mention me directly with the file. Thanks! (Error: Missing event details for threading)"
@@ -197,7 +1079,7 @@ def handle_file_shared_events(body, say, logger):
     )
 
     try:
-        say(
+        await say(
             channel=channel_id,
             text=reply_message,
             thread_ts=original_event_ts # Use the original_event_ts directly
@@ -207,7 +1089,7 @@ def handle_file_shared_events(body, say, logger):
         logger.error(f"Error sending THREADED message (using say, ts: {original_event_ts}) for standalone file_shared event {event_id}: {e}")
         # Fallback to non-threaded if threaded reply fails
         try:
-            say(
+            await say(
                 channel=channel_id,
                 text=f"Sorry <@{user_id}>, I tried to reply in a thread about your file `{file_id}` but encountered an issue. "
                      f"Please @mention me directly with the file for a review. Thanks!"
@@ -217,9 +1099,16 @@ def handle_file_shared_events(body, say, logger):
             logger.error(f"Error sending critical NON-THREADED fallback message (using say) for event {event_id}: {e_fallback_critical}")
 
 @app.event("app_mention")
-def handle_app_mention_events(body, say, logger):
+async def handle_app_mention_events(body, event, say, logger):
     """Handles mentions of the bot. If a file is included in the mention, it processes the file."""
-    event = body["event"]
+    current_time = time.monotonic()
+    # Slack retries redeliver the same event_id; a fresh mention (even of the same file) gets a new one.
+    # Without an event_id, the mention's channel and timestamp identify it just as well.
+    dedup_key = body.get("event_id") or f"{event.get('channel')}:{event.get('event_ts')}"
+    if not _claim(_PROCESSED_EVENTS, dedup_key, MAX_EVENT_ID_AGE_SECONDS, current_time, kind="event"):
+        logger.info(f"handle_app_mention_events: Ignoring duplicate delivery of mention {dedup_key}")
+        return
+
     user_id = event["user"]
     text = event.get("text", "") # Get text, default to empty string if not present
     channel_id = event.get("channel")
@@ -239,146 +1128,54 @@ def handle_app_mention_events(body, say, logger):
 
         if not mentioned_file_id:
             logger.error(f"App mention by {user_id} included files, but file_id was missing. Files: {uploaded_files}")
-            say(f"Sorry <@{user_id}>, I saw you uploaded a file with your mention, but I couldn't get its ID.", channel=channel_id, thread_ts=thread_ts_to_reply)
+            await say(f"Sorry <@{user_id}>, I saw you uploaded a file with your mention, but I couldn't get its ID.", channel=channel_id, thread_ts=thread_ts_to_reply)
             return
 
-        # Mark this file_id as processed by the mention handler to prevent file_shared handler from duplicating
-        current_time_for_mention = time.time()
-        MENTION_PROCESSED_FILE_IDS.add(mentioned_file_id)
-        MENTION_FILE_ID_TIMESTAMPS[mentioned_file_id] = current_time_for_mention
+        # Marks the file as handled by a mention, so the file_shared handler doesn't also reply about it
+        _remember(_MENTION_PROCESSED_FILES, mentioned_file_id, MAX_MENTION_FILE_ID_AGE_SECONDS, current_time)
         logger.info(f"handle_app_mention_events: Marked file_id {mentioned_file_id} as processed by mention (event_ts: {thread_ts_to_reply}).")
 
         logger.info(f"App mention by {user_id} in channel {channel_id} included file_id: {mentioned_file_id}. Processing image...")
-        # --- Start of image processing logic (adapted from handle_file_shared_events) ---
-        try:
-            file_info_response = app.client.files_info(file=mentioned_file_id)
-            if not file_info_response.get("ok"):
-                logger.error(f"Failed to get file info for {mentioned_file_id}: {file_info_response.get('error')}")
-                say(text=f"Sorry <@{user_id}>, I couldn't retrieve information about the file you shared with your mention.", channel=channel_id, thread_ts=thread_ts_to_reply)
-                return
-
-            file_data = file_info_response.get("file")
-            slack_mimetype = file_data.get("mimetype", "").lower()
-            file_url_private = file_data.get("url_private_download")
-
-            if slack_mimetype.startswith("image/"):
-                logger.info(f"Processing uploaded image: {file_data.get('name')} ({slack_mimetype}) from app_mention.")
-
-                if not file_url_private:
-                    logger.error(f"Private download URL not found for the image {mentioned_file_id} in app_mention.")
-                    say(text=f"Sorry <@{user_id}>, I couldn't access the image file you shared with your mention.", channel=channel_id, thread_ts=thread_ts_to_reply)
-                    return
-
-                headers = {"Authorization": f"Bearer {SLACK_BOT_TOKEN}"}
-                response = requests.get(file_url_private, headers=headers, stream=True)
-                response.raise_for_status()
-
-                uploaded_image_bytes = response.content
-                uploaded_pil_image = Image.open(BytesIO(uploaded_image_bytes))
-                uploaded_image_format = uploaded_pil_image.format.lower()
-                uploaded_image_mimetype = f"image/{uploaded_image_format}"
-                if uploaded_image_format == 'jpg': uploaded_image_mimetype = "image/jpeg"
-
-                base64_uploaded_image = base64.b64encode(uploaded_image_bytes).decode("utf-8")
-                
-                say(text=f"Thanks <@{user_id}>! I've received your image with your mention. Analyzing it with contextual examples...", channel=channel_id, thread_ts=thread_ts_to_reply)
-
-                example_contexts = get_example_context_data(logger)
-
-                main_prompt_instructions = f"""
-                    You are a creative performance analyst evaluating mobile or desktop ad creatives.
-                    Your task:
-                    1. Estimate a creative score from 0–100 based on likely ad performance
-                    2. Highlight 1–2 visual strengths
-                    3. Call out 1–2 weaknesses
-                    4. Suggest 2–3 specific improvements
-                    5. Summarize the image data that informed your decision
-                    Be concise but human. Focus on clarity, visual hierarchy, and user impact—not just aesthetics.
-                    ---
-                    Please review and score this image based on its visual characteristics
-                    Respond in this exact format:
-                    --> Score: ##/100
-                    --> Strengths:
-                    • [1-line bullet]
-                    • [Optional 2nd bullet]
-                    -->  Weaknesses:
-                    • [1-line bullet]
-                    • [Optional 2nd bullet]
-                    --> Suggestions:
-                    • [Change 1]
-                    • [Change 2]
-                    • [Optional Change 3]
-                    --> Image Data Summary:
-                    ---
-                    """
-                prompt_messages_content = [
-                    {"type": "text", "text": main_prompt_instructions},
-                    {"type": "image_url", "image_url": {"url": f"data:{uploaded_image_mimetype};base64,{base64_uploaded_image}"}}
-                ]
-
-                if not example_contexts:
-                    logger.warning("No example contexts found for app_mention image review.")
-                    prompt_messages_content.append({
-                        "type": "text",
-                        "text": "Historic Data for scoring:\\n• No example data was available for this review."
-                    })
-                else:
-                    historic_data_header = "Historic Data for scoring:"
-                    example_data_texts = []
-                    for i, ex_data in enumerate(example_contexts):
-                        example_data_texts.append(
-                            f"--- Example {i+1} (Filename: {ex_data['filename']}) ---\\nPerformance Info: {ex_data['performance_info']}\\n--- End Example {i+1} ---"
-                        )
-                        example_data_texts.append({
-                            "type": "image_url",
-                            "image_url": {"url": f"data:{ex_data['mime_type']};base64,{ex_data['base64_image']}"}
-                        })
-                    prompt_messages_content.append({"type": "text", "text": historic_data_header})
-                    prompt_messages_content.extend(example_data_texts)
-
-                try:
-                    chat_completion = openai_client.chat.completions.create(
-                        model="gpt-4o", 
-                        messages=[{"role": "user", "content": prompt_messages_content}],
-                        max_tokens=1000
-                    )
-                    review = chat_completion.choices[0].message.content
-                    say(text=f"<@{user_id}>, here's the review for your image {file_data.get('name')}:\n{review}", channel=channel_id, thread_ts=thread_ts_to_reply)
-                except Exception as e:
-                    logger.error(f"Error calling OpenAI API during app_mention: {e}")
-                    say(text=f"Sorry <@{user_id}>, I encountered an error with the AI review for the image in your mention.", channel=channel_id, thread_ts=thread_ts_to_reply)
-            else:
-                logger.info(f"File {mentioned_file_id} shared with app_mention by {user_id} is not an image: {slack_mimetype}. Replying with help text.")
-                say(text=f"Hi <@{user_id}>! You mentioned me with a file, but I can only process image files. Please try mentioning me with an image.", channel=channel_id, thread_ts=thread_ts_to_reply)
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error downloading file {mentioned_file_id} from app_mention: {e}")
-            say(text=f"Sorry <@{user_id}>, I had trouble downloading the file you shared with your mention.", channel=channel_id, thread_ts=thread_ts_to_reply)
-        except Exception as e:
-            logger.error(f"Error processing file {mentioned_file_id} from app_mention: {e}")
-            say(text=f"Sorry <@{user_id}>, an unexpected error occurred while processing the file in your mention.", channel=channel_id, thread_ts=thread_ts_to_reply)
-        # --- End of image processing logic ---
+        await _process_shared_file(mentioned_file_id, user_id, channel_id, thread_ts_to_reply, say, logger, uploaded_files[0])
     else:
         # No files attached to the mention, just a simple mention
-        say(f"Hi <@{user_id}>! You mentioned me. If you share an image when you mention me, I can help review it.", channel=channel_id, thread_ts=thread_ts_to_reply)
+        await say(f"Hi <@{user_id}>! You mentioned me. If you share an image when you mention me, I can help review it.", channel=channel_id, thread_ts=thread_ts_to_reply)
+
+def _bot_identity(body):
+    """Returns (bot_user_id, mention_text), preferring the values cached at startup over the event's authorizations."""
+    if _BOT_USER_ID is not None:
+        return _BOT_USER_ID, _BOT_MENTION
+    authorizations = body.get("authorizations")
+    bot_id = authorizations[0].get("user_id") if authorizations else None
+    return bot_id, (f"<@{bot_id}>" if bot_id else None)
+
+def _log_message_event_summary(body, event, logger):
+    """Logs the identifying fields of a message event; the full body (which can be large) only at DEBUG level."""
+    logger.info(
+        f"Message event summary: subtype={event.get('subtype')} user={event.get('user')} channel={event.get('channel')} "
+        f"ts={event.get('ts')} keys={list(event.keys())}"
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(body)
 
 # Add this handler if you want to acknowledge/log other message types or subtypes
 # without them showing as "unhandled".
 @app.event("message")
-def handle_generic_message_events(body, logger, say):
-    event = body.get("event", {})
+async def handle_generic_message_events(body, event, logger, say):
+    # Bolt passes the already-parsed event, so each field is read from it once
     event_subtype = event.get("subtype")
+    event_user = event.get("user")
     text = event.get("text", "")
-    authorizations = body.get("authorizations", [])
-    bot_id = authorizations[0].get("user_id") if authorizations else None
+    bot_id, bot_mention = _bot_identity(body)
 
-    if event.get("user") == bot_id or event.get("bot_id") is not None:
+    if event_user == bot_id or event.get("bot_id") is not None:
         return
         
     if event_subtype == "file_share":
-        logger.info(f"handle_generic_message_events: Detected standalone file_share subtype by user {event.get('user')}. This is now ignored as primary processing happens via app_mention with files.")
+        logger.info(f"handle_generic_message_events: Detected standalone file_share subtype by user {event_user}. This is now ignored as primary processing happens via app_mention with files.")
         return 
 
-    if bot_id and f"<@{bot_id}>" in text:
+    if bot_mention and bot_mention in text:
         logger.info(f"handle_generic_message_events: Ignoring message with mention as it should be handled by app_mention: {text}")
         return
 
@@ -387,21 +1184,36 @@ def handle_generic_message_events(body, logger, say):
     
     if event_subtype is not None:
         logger.info(f"handle_generic_message_events: Received a message event with unhandled subtype: {event_subtype}")
-        logger.info(body)
+        _log_message_event_summary(body, event, logger)
         return 
 
-    logger.info(f"handle_generic_message_events: Received a generic message (not a mention, file_share, or known unhandled subtype) by user {event.get('user')}:")
-    logger.info(body)
+    logger.info(f"handle_generic_message_events: Received a generic message (not a mention, file_share, or known unhandled subtype) by user {event_user}:")
+    _log_message_event_summary(body, event, logger)
 
 
+async def main():
+    global _BOT_USER_ID, _BOT_MENTION
+    try:
+        auth_response = await app.client.auth_test()
+        _BOT_USER_ID = auth_response["user_id"]
+        _BOT_MENTION = f"<@{_BOT_USER_ID}>"
+    except Exception as e:
+        module_logger.warning(f"Could not look up the bot user ID at startup; using each event's authorizations instead: {e}")
+
+    handler = AsyncSocketModeHandler(app, SLACK_APP_TOKEN)
+    try:
+        await handler.start_async()
+    finally:
+        await slack_http_client.aclose()
+        await openai_client.close()
+
 # Start your app
 if __name__ == "__main__":
     # SocketModeHandler is common for development as it doesn't require a public URL.
     # For production, you might use a different way to start the app (e.g., a web server like Gunicorn).
     # Ensure SLACK_APP_TOKEN is set in your .env file for Socket Mode.
     if SLACK_APP_TOKEN and SLACK_BOT_TOKEN and OPENAI_API_KEY:
-        handler = SocketModeHandler(app, SLACK_APP_TOKEN)
-        handler.start()
+        asyncio.run(main())
     else:
         logging.error("Missing one or more required environment variables: SLACK_BOT_TOKEN, SLACK_APP_TOKEN, OPENAI_API_KEY")
-        print("Error: Ensure SLACK_BOT_TOKEN, SLACK_APP_TOKEN, and OPENAI_API_KEY are set in your .env file.") 
\ No newline at end of file
+        print("Error: Ensure SLACK_BOT_TOKEN, SLACK_APP_TOKEN, and OPENAI_API_KEY are set in your .env file.")
\ No newline at end of file
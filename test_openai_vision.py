@@ -1,9 +1,11 @@
 import os
-import base64
+import mimetypes
+try:
+    import pybase64 as base64  # Optional SIMD-accelerated drop-in for the stdlib module
+except ImportError:
+    import base64
 from openai import OpenAI
 from dotenv import load_dotenv
-from PIL import Image # To determine image type
-import io
 
 # Load environment variables from .env file
 load_dotenv()
@@ -18,30 +20,41 @@ if not OPENAI_API_KEY:
 # Initialize OpenAI client
 client = OpenAI(api_key=OPENAI_API_KEY)
 
+# Leading bytes of each image type OpenAI accepts. WebP is checked separately: its RIFF magic is split around a 4-byte size field.
+MIME_BY_MAGIC = {
+    b"\xff\xd8\xff": "image/jpeg",
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+}
+
+def sniff_image_mime_type(header):
+    """Returns the MIME type implied by an image's first 12 bytes, or None for formats the API doesn't accept."""
+    for magic, mime_type in MIME_BY_MAGIC.items():
+        if header[:len(magic)] == magic:
+            return mime_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
 def encode_image_to_base64(image_path):
     """Encodes a local image file to a base64 string and determines its MIME type."""
     try:
         with open(image_path, "rb") as image_file:
-            # Read the image into memory to determine format with Pillow
-            image_bytes = image_file.read()
-            pil_image = Image.open(io.BytesIO(image_bytes))
-            image_format = pil_image.format.lower()
-            
-            if image_format == 'jpeg' or image_format == 'jpg':
-                mime_type = "image/jpeg"
-            elif image_format == 'png':
-                mime_type = "image/png"
-            elif image_format == 'gif':
-                mime_type = "image/gif"
-            elif image_format == 'webp':
-                mime_type = "image/webp"
-            else:
+            # Chunks are a multiple of 3 bytes, so each one encodes to base64 without padding
+            chunk = image_file.read(57 * 1024)
+            # The format is fully determined by the file's magic bytes; no need to have Pillow parse it
+            mime_type = sniff_image_mime_type(chunk[:12]) or mimetypes.guess_type(image_path)[0]
+            if mime_type is None or not mime_type.startswith("image/"):
                 # Fallback or raise error if format is not commonly supported for web/API
-                print(f"Warning: Detected image format '{image_format}' may not be optimally supported. Attempting with image/png.")
+                print("Warning: Image format not recognized as JPEG, PNG, GIF or WebP. Attempting with image/png.")
                 mime_type = "image/png" # Defaulting to PNG as a common safe bet
-            
-            base64_image = base64.b64encode(image_bytes).decode("utf-8")
-            return f"data:{mime_type};base64,{base64_image}"
+
+            encoded_parts = []
+            while chunk:
+                encoded_parts.append(base64.b64encode(chunk).decode("ascii"))
+                chunk = image_file.read(57 * 1024)
+            return f"data:{mime_type};base64,{''.join(encoded_parts)}"
     except FileNotFoundError:
         print(f"Error: Image file not found at {image_path}")
         return None